@@ -5,6 +5,10 @@ import argparse
 import datetime
 import time
 import random
+import functools
+import hashlib
+import shutil
+import tempfile
 from PIL import Image
 import pickle
 import json
@@ -27,8 +31,9 @@ import torchvision.transforms as T
 
 verbose = False
 
-def set_deterministic(seed):
-    # seed by default is None
+def set_deterministic(seed, cudnn_benchmark=False):
+    # seed by default is None. cudnn_benchmark lets cudnn autotune its
+    # (nondeterministic) conv algorithms; the seeds are still set
     if seed is not None:
         print("Deterministic with seed = " + str(seed))
         random.seed(seed)
@@ -36,20 +41,41 @@ def set_deterministic(seed):
         torch.manual_seed(seed)
         if torch.cuda.is_available():
             torch.cuda.manual_seed(seed)
-            torch.backends.cudnn.deterministic = True
-            torch.backends.cudnn.benchmark = False
+            torch.backends.cudnn.deterministic = not cudnn_benchmark
+            torch.backends.cudnn.benchmark = cudnn_benchmark
+
+def mixed_precision(enabled):
+    # autocast settings for the training loops (cuda only). bf16 has the
+    # range of fp32, so the grad scaler is only switched on for fp16
+    enabled = enabled and torch.cuda.is_available()
+    dtype = torch.bfloat16 if enabled and torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.amp.GradScaler("cuda", enabled=enabled and dtype == torch.float16)
+    return enabled, dtype, scaler
+
+def compile_model(model, enabled):
+    # torch.compile for the training forward pass, eager otherwise.
+    # the uncompiled module is kept around for saving checkpoints
+    if enabled:
+        return torch.compile(model, mode="reduce-overhead")
+    return model
+
+def _scan_files(folder, ext):
+    # like os.walk, unreadable or missing directories are skipped; errors on
+    # single files (e.g. a dangling symlink) propagate, as os.stat did before
+    try:
+        it = os.scandir(folder)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_files(entry.path, ext)
+            elif entry.name.endswith(ext):
+                yield entry.stat().st_mtime, entry.path
 
-def most_recent_file(folder, ext=""):
-    max_time = 0
-    max_file = ""
-    for dirname, subdirs, files in os.walk(folder):
-        for fname in files:
-            full_path = os.path.join(dirname, fname)
-            time = os.stat(full_path).st_mtime
-            if time > max_time and full_path.endswith(ext):
-                max_time = time
-                max_file = full_path
 
+def most_recent_file(folder, ext=""):
+    max_time, max_file = max(_scan_files(folder, ext), key=lambda f: f[0], default=(0, ""))
     return max_file
 
 class LRScheduler(object):
@@ -64,19 +90,26 @@ class LRScheduler(object):
         self.base_lr = base_lr
         self.constant_predictor_lr = constant_predictor_lr
         warmup_iter = iter_per_epoch * warmup_epochs
-        warmup_lr_schedule = np.linspace(warmup_lr, base_lr, warmup_iter)
         decay_iter = iter_per_epoch * (num_epochs - warmup_epochs)
-        cosine_lr_schedule = final_lr + 0.5 * (base_lr - final_lr) * (
-                1 + np.cos(np.pi * np.arange(decay_iter) / decay_iter))
-
-        self.lr_schedule = np.concatenate((warmup_lr_schedule, cosine_lr_schedule))
+        lr_schedule = np.empty(warmup_iter + decay_iter)
+        lr_schedule[:warmup_iter] = np.linspace(warmup_lr, base_lr, warmup_iter)
+        cosine_lr_schedule = lr_schedule[warmup_iter:]
+        np.cos(np.linspace(0, np.pi, decay_iter, endpoint=False), out=cosine_lr_schedule)
+        cosine_lr_schedule += 1
+        cosine_lr_schedule *= 0.5 * (base_lr - final_lr)
+        cosine_lr_schedule += final_lr
+
+        # python floats: param_group['lr'] is read as a float every step
+        self.lr_schedule = lr_schedule.tolist()
         self.optimizer = optimizer
+        self.groups = optimizer.param_groups
         self.iter = 0
         self.current_lr = 0
 
     def step(self):
-        for param_group in self.optimizer.param_groups:
-            lr = param_group['lr'] = self.lr_schedule[self.iter]
+        lr = self.lr_schedule[self.iter]
+        for param_group in self.groups:
+            param_group['lr'] = lr
 
         self.iter += 1
         self.current_lr = lr
@@ -86,8 +119,14 @@ class LRScheduler(object):
         return self.current_lr
 
 def euclidean_dist(z1, z2):
-    n = z1.shape[0]
-    return 2 * z1 @ z2.T - torch.diagonal(z1 @ z1.T).repeat(n).reshape((n,n)).T - torch.diagonal(z2 @ z2.T).repeat(n).reshape((n,n))
+    # negative squared distances between all rows of z1 and z2
+    sq1 = (z1 * z1).sum(dim=1)
+    sq2 = (z2 * z2).sum(dim=1)
+    return 2 * z1 @ z2.T - sq1[:, None] - sq2[None, :]
+
+def euclidean_diag(z1, z2):
+    # diagonal of euclidean_dist(z1, z2), without the other n^2 - n entries
+    return - ((z1 - z2) ** 2).sum(dim=1)
 
 def simsiam_loss(p, z, distance="cosine"):
     """
@@ -100,18 +139,30 @@ def simsiam_loss(p, z, distance="cosine"):
     :return: -cosine_similarity(p, z)
     """
     if distance == "euclidean":
-        return - torch.diagonal(euclidean_dist(p, z.detach())).mean()
+        return - euclidean_diag(p, z.detach()).mean()
     elif distance == "cosine":
         return - F.cosine_similarity(p, z.detach(), dim=-1).mean()
 
 
-def info_nce(z1, z2, temperature=0.1, distance="cosine"):
+# positive-pair targets for info_nce, one tensor per (batch size, device)
+_label_cache = {}
+
+
+def _labels(n, device):
+    key = (n, device)
+    if key not in _label_cache:
+        _label_cache[key] = torch.arange(0, n, dtype=torch.long, device=device)
+    return _label_cache[key]
+
+
+def info_nce(z1, z2, temperature=0.1, distance="cosine", symmetric=False):
     """
     Noise contrastive estimation loss.
     Contrastive learning loss with *both* positive and negative terms.
     :param z1: first vector
     :param z2: second vector
     :param temperature: how sharp the prediction task is
+    :param symmetric: average with infoNCE(z2, z1), whose logits are the transpose
     :return: infoNCE(z1, z2)
     """
     if z1.size()[1] <= 1 and distance == "cosine":
@@ -125,17 +176,94 @@ def info_nce(z1, z2, temperature=0.1, distance="cosine"):
         logits = euclidean_dist(z1, z2)
 
     logits /= temperature
-    if torch.cuda.is_available():
-        logits = logits.cuda()
 
-    n = z1.shape[0]
-    labels = torch.arange(0, n, dtype=torch.long)
-    if torch.cuda.is_available():
-        labels = labels.cuda()
+    labels = _labels(z1.shape[0], logits.device)
 
     loss = torch.nn.functional.cross_entropy(logits, labels)
+    if symmetric:
+        loss = 0.5 * loss + 0.5 * torch.nn.functional.cross_entropy(logits.T, labels)
     return loss
 
+def torch_ellipj(u, m):
+    """
+    Jacobian elliptic functions in torch, so they can be evaluated on the GPU.
+    Same AGM / descending Landen method (and edge cases) as scipy.special.ellipj.
+    :param u: argument
+    :param m: parameter, 0 <= m <= 1
+    :return: sn, cn, dn, ph
+    """
+    u, m = torch.broadcast_tensors(u, m)
+
+    # 8 AGM steps reach machine precision for m < 0.9999999999
+    a = [torch.ones_like(m)]
+    c = [torch.sqrt(m)]
+    b = torch.sqrt(1 - m)
+    for i in range(8):
+        c.append((a[i] - b) / 2)
+        a.append((a[i] + b) / 2)
+        b = torch.sqrt(a[i] * b)
+
+    phi = 2 ** 8 * a[8] * u
+    for i in range(8, 0, -1):
+        b = phi
+        phi = (torch.asin(c[i] * torch.sin(phi) / a[i]) + phi) / 2
+
+    sn = torch.sin(phi)
+    cn = torch.cos(phi)
+    dn = cn / torch.cos(phi - b)
+    ph = phi
+
+    # m close to 0
+    small = m < 1e-9
+    t = torch.sin(u)
+    b = torch.cos(u)
+    ai = 0.25 * m * (u - t * b)
+    sn = torch.where(small, t - ai * b, sn)
+    cn = torch.where(small, b + ai * t, cn)
+    dn = torch.where(small, 1 - 0.5 * m * t * t, dn)
+    ph = torch.where(small, u - ai, ph)
+
+    # m close to 1
+    big = m >= 0.9999999999
+    ai = 0.25 * (1 - m)
+    b = torch.cosh(u)
+    t = torch.tanh(u)
+    phi = 1 / b
+    twon = b * torch.sinh(u)
+    sn = torch.where(big, t + ai * (twon - u) / (b * b), sn)
+    ph = torch.where(big, 2 * torch.atan(torch.exp(u)) - np.pi / 2 + ai * (twon - u) / b, ph)
+    ai = ai * t * phi
+    cn = torch.where(big, phi - ai * (twon - u), cn)
+    dn = torch.where(big, phi + ai * (twon + u), dn)
+
+    invalid = (m < 0) | (m > 1)
+    return [torch.where(invalid, torch.full_like(x, np.nan), x) for x in (sn, cn, dn, ph)]
+
+def fast_ellipj(t, k2):
+    """
+    ellipj on the GPU when there is one, otherwise scipy. Takes and returns numpy arrays.
+    """
+    if not torch.cuda.is_available():
+        return ellipj(t, k2)
+
+    t = torch.from_numpy(np.asarray(t, dtype=np.float64)).cuda()
+    k2 = torch.from_numpy(np.asarray(k2, dtype=np.float64)).cuda()
+    return [x.cpu().numpy() for x in torch_ellipj(t, k2)]
+
+@functools.lru_cache(maxsize=8)
+def raster_grid(data_size, traj_samples, bob_size):
+    """
+    Index arrays for scattering bobs into a (data_size, traj_samples, ...) image batch.
+    They only depend on the shapes, so they are cached (read-only) across calls.
+    :return: pendulum index, sample index, bob x offsets, bob y offsets
+    """
+    b_idx = np.arange(data_size).reshape((-1, 1, 1, 1))
+    t_idx = np.arange(traj_samples).reshape((1, -1, 1, 1))
+    dx, dy = np.mgrid[-bob_size:bob_size + 1, -bob_size:bob_size + 1]
+    for arr in (b_idx, t_idx, dx, dy):
+        arr.flags.writeable = False
+    return b_idx, t_idx, dx, dy
+
 def pendulum_train_gen(data_size, traj_samples=10, gnoise=0., nnoise=0., uniform=False,
         shuffle=True, check_energy=False, k2=None, image=True,
         blur=False, img_size=32, diff_time=0.5, bob_size=1, continuous=False,
@@ -172,14 +300,23 @@ def pendulum_train_gen(data_size, traj_samples=10, gnoise=0., nnoise=0., uniform
         t = rng.uniform(0, 10. * traj_samples, size=(data_size, traj_samples))
         k2 = rng.uniform(size=(data_size, 1)) if k2 is None else k2 * np.ones((data_size, 1))  # energies (conserved)
 
-        sn, cn, dn, _ = ellipj(t, k2)
-        q = 2 * np.arcsin(np.sqrt(k2) * sn) # angle
-        p = 2 * np.sqrt(k2) * cn * dn / np.sqrt(1 - k2 * sn ** 2) # anglular momentum
-        data = np.stack((q, p), axis=-1)
+        sn, cn, dn, _ = fast_ellipj(t, k2)
+
+        # q and p are written straight into the output instead of stacked
+        data = np.empty((data_size, traj_samples, 2))
+        q = data[:, :, 0]
+        p = data[:, :, 1]
+        sqrt_k2 = np.sqrt(k2)
+        np.multiply(sqrt_k2, sn, out=q)
+        np.arcsin(q, out=q)
+        q *= 2 # angle
+        np.multiply(sqrt_k2, cn, out=p)
+        p *= 2 # anglular momentum, 2 sqrt(k2) cn dn / sqrt(1 - k2 sn^2) with dn = sqrt(1 - k2 sn^2)
 
         if shuffle:
-            for x in data:
-                rng.shuffle(x, axis=0)
+            # one permutation per trajectory, moving (q, p) pairs together
+            perm = rng.permuted(np.tile(np.arange(traj_samples), (data_size, 1)), axis=1)
+            data = np.take_along_axis(data, perm[:, :, None], axis=1)
 
         if check_energy:
             H = 0.5 * p ** 2 - np.cos(q) + 1
@@ -187,8 +324,8 @@ def pendulum_train_gen(data_size, traj_samples=10, gnoise=0., nnoise=0., uniform
             print("max diffH = ", np.max(np.abs(diffH)))
             assert np.allclose(diffH, np.zeros_like(diffH))
 
-        if noise > 0:
-            data += noise * rng.standard_normal(size=data.shape)
+        if nnoise > 0:
+            data += nnoise * rng.standard_normal(size=data.shape)
 
         return k2, data
 
@@ -220,30 +357,33 @@ def pendulum_train_gen(data_size, traj_samples=10, gnoise=0., nnoise=0., uniform
             if k2 == None:
                 if not uniform:
                     k2 = rng.uniform(0, 1 - gaps[1], size=(data_size, 1, 1))
-                    prefix = np.floor(k2 / (1 - gaps[1]) * (gaps[0] + 1)) * ((1 - gaps[1]) / (gaps[0] + 1) + gaps[1] / gaps[0])
-                    frac = k2 - np.floor(k2 / (1 - gaps[1]) * (gaps[0] + 1)) * (1 - gaps[1]) / (gaps[0] + 1)
-                    k2 = prefix + frac
-                    k2 = k2 * (maxk - mink) + mink
                 else:
                     k2 = np.linspace(0, 1 - gaps[1], num=data_size, endpoint=False)
                     k2 = np.reshape(k2, (data_size, 1, 1))
-                    prefix = np.floor(k2 / (1 - gaps[1]) * (gaps[0] + 1)) * ((1 - gaps[1]) / (gaps[0] + 1) + gaps[1] / gaps[0])
-                    frac = k2 - np.floor(k2 / (1 - gaps[1]) * (gaps[0] + 1)) * (1 - gaps[1]) / (gaps[0] + 1)
-                    k2 = prefix + frac
-                    k2 = k2 * (maxk - mink) + mink
+                # energies are drawn from [0, 1 - total gap length]; each one is then
+                # shifted up by the gaps below its segment
+                segment = np.floor(k2 / (1 - gaps[1]) * (gaps[0] + 1))
+                k2 += segment * (gaps[1] / gaps[0])
+                k2 = k2 * (maxk - mink) + mink
             else:
                 k2 = k2 * np.ones((data_size, 1, 1))
 
-        sn, cn, dn, _ = ellipj(t, k2)
-        q = 2 * np.arcsin(np.sqrt(k2) * sn)
+        sn, cn, dn, _ = fast_ellipj(t, k2)
+        # sin and cos of q / 2
+        half_sin = np.sqrt(k2) * sn
+        half_cos = dn
+
+        if shuffle:
+            # one permutation per trajectory, moving both frames' angles together
+            perm = rng.permuted(np.tile(np.arange(traj_samples), (data_size, 1)), axis=1)
+            half_sin = np.take_along_axis(half_sin, perm[:, :, None], axis=1)
+            half_cos = np.take_along_axis(half_cos, perm[:, :, None], axis=1)
+
+        q = 2 * np.arcsin(half_sin)
 
         if verbose:
             print("[Dataset] Numerical generation complete")
 
-        if shuffle:
-            for x in q:
-                rng.shuffle(x, axis=0) # TODO: check if the shapes work out
-
         if nnoise > 0:
             q += nnoise * rng.standard_normal(size=q.shape)
 
@@ -260,66 +400,69 @@ def pendulum_train_gen(data_size, traj_samples=10, gnoise=0., nnoise=0., uniform
         center_x = big_img // 2
         center_y = big_img // 2
         str_len = big_img - 4 - big_img // 2 - bob_size
-        bob_area = (2 * bob_size + 1)**2
 
-        pxls = np.ones((data_size, traj_samples, img_size + 2, img_size + 2, 3))
+        # allocated directly in the (channel, y, x) layout the encoder consumes
+        pxls = np.ones((data_size, traj_samples, 3, img_size + 2, img_size + 2), dtype=np.uint8)
         if verbose:
             print("[Dataset] Blank images created")
 
-        x = center_x + np.round(np.cos(q) * str_len)
-        y = center_y + np.round(np.sin(q) * str_len)
-
-        idx = np.indices((data_size, traj_samples))
-        idx = np.expand_dims(idx, [0, 1, 5])
-
-        bob_idx = np.indices((2 * bob_size + 1, 2 * bob_size + 1)) - bob_size
-        bob_idx = np.swapaxes(bob_idx, 0, 2)
-        bob_idx = np.expand_dims(bob_idx, [3, 4, 5])
-
-        pos = np.expand_dims(np.stack((x, y), axis=0), [0, 1])
-        pos = pos + bob_idx
-        pos = np.reshape(pos, (bob_area, 2, data_size, traj_samples, 2))
-        pos = np.expand_dims(pos, 0)
-
-        c = np.expand_dims(np.array([[1, 1], [0, 2]]), [1, 2, 3, 4])
-
-        idx, pos, c = np.broadcast_arrays(idx, pos, c)
-        c = np.expand_dims(c[:, :, 0, :, :, :], 2)
-        idx_final = np.concatenate((idx, pos, c), axis=2)
+        # bob positions. without angle noise, cos(q) and sin(q) follow from the
+        # half angle by the double angle formulas, with no trig calls
+        if nnoise > 0:
+            cos_q = np.cos(q)
+            sin_q = np.sin(q)
+        else:
+            cos_q = half_sin * half_sin
+            cos_q *= -2
+            cos_q += 1
+            sin_q = half_sin * half_cos
+            sin_q *= 2
+        del half_sin, half_cos
+        cos_q *= str_len
+        np.rint(cos_q, out=cos_q)
+        x = cos_q.astype('int32')
+        x += center_x
+        sin_q *= str_len
+        np.rint(sin_q, out=sin_q)
+        y = sin_q.astype('int32')
+        y += center_y
+        del cos_q, sin_q
 
         if gnoise > 0:
             translation_noise = rng.uniform(0, 1, size=(2, data_size, traj_samples))
             translation_noise = np.minimum(np.ones(translation_noise.shape),
                                     np.floor(np.abs(translation_noise) / (1 - 2 * gnoise))) * translation_noise / np.abs(translation_noise)
-            translation_noise = np.concatenate((np.zeros(translation_noise.shape), translation_noise, np.zeros(translation_noise.shape)), axis=0)
-            translation_noise = translation_noise[:5]
-            translation_noise = np.expand_dims(translation_noise, [0, 1, 5])
-            idx_final = idx_final + translation_noise
+            translation_noise = np.expand_dims(translation_noise, 3).astype('int32')
+            x += translation_noise[0]
+            y += translation_noise[1]
+
+        # offset from big image coordinates to the padded (cropped) buffer
+        if crop == 1.0:
+            x_off = 1
+            y_off = 1
+        else:
+            x_off = 1 - int(left)
+            y_off = 1 - int(top)
+
+        b_idx, t_idx, dx, dy = raster_grid(data_size, traj_samples, bob_size)
 
-        idx_final = np.swapaxes(idx_final, 0, 2)
-        idx_final = np.reshape(idx_final, (5, 4 * data_size * traj_samples * bob_area))
-        idx_final = idx_final.astype('int32')
+        # first frame blanks channels 0 & 1, second frame blanks channels 1 & 2;
+        # anything outside the crop lands in the border, which is cut off below.
+        # writes go through one linear index into a flat view of pxls
+        flat = pxls.reshape(-1)
+        for k, channels in enumerate([[0, 1], [1, 2]]):
+            px = np.clip(x[:, :, k, None, None] + dx + x_off, 0, img_size + 1)
+            py = np.clip(y[:, :, k, None, None] + dy + y_off, 0, img_size + 1)
+            ch = np.reshape(channels, (-1, 1, 1, 1, 1))
+            flat[np.ravel_multi_index((b_idx, t_idx, ch, py, px), pxls.shape)] = 0
 
         if verbose:
             print("[Dataset] Color indices computed")
-        if crop == 1.0:
-            pxls[idx_final[0], idx_final[1], idx_final[2] + 1, idx_final[3] + 1, idx_final[4]] = 0
-        else:
-            #bigpxls = np.ones((data_size, traj_samples, big_img + 2, big_img + 2, 3))
-            #bigpxls[idx_final[0], idx_final[1], idx_final[2] + 1, idx_final[3] + 1, idx_final[4]] = 0
-            idx_final[2] = idx_final[2] - left.astype('int32') + 1
-            idx_final[3] = idx_final[3] - top.astype('int32') + 1
-            idx_final[2] = np.maximum(idx_final[2], np.array(0))
-            idx_final[3] = np.maximum(idx_final[3], np.array(0))
-            idx_final[2] = np.minimum(idx_final[2], np.array(img_size + 1))
-            idx_final[3] = np.minimum(idx_final[3], np.array(img_size + 1))
-
-            pxls[idx_final[0], idx_final[1], idx_final[2], idx_final[3], idx_final[4]] = 0
-        pxls = pxls[:, :, 1:img_size + 1, 1:img_size + 1, :]
+        pxls = pxls[:, :, :, 1:img_size + 1, 1:img_size + 1]
 
         if gnoise > 0:
             pxls = pxls + gnoise / 4 * rng.standard_normal(size=pxls.shape)
-            tint_noise = rng.uniform(- gnoise / 8, gnoise / 8, size=(data_size, traj_samples, 1, 1, 3))
+            tint_noise = rng.uniform(- gnoise / 8, gnoise / 8, size=(data_size, traj_samples, 3, 1, 1))
             pxls = pxls + tint_noise
             pxls = np.minimum(np.ones(pxls.shape), np.maximum(np.zeros(pxls.shape), pxls))
 
@@ -341,31 +484,68 @@ def pendulum_train_gen(data_size, traj_samples=10, gnoise=0., nnoise=0., uniform
                 input("continue...")
                 #plt.clf()"""
 
-        pxls = np.swapaxes(pxls, 4, 2)
+        # contiguous uint8 (float32 with gnoise) so samples are cheap to copy;
+        # the training loops convert to float on the device
+        if gnoise > 0:
+            pxls = pxls.astype(np.float32)
+        pxls = np.ascontiguousarray(pxls)
         return np.broadcast_arrays(k2, q)[0], pxls, q
 
 
+# bump whenever pendulum_train_gen changes what it returns, so old caches are not reused
+_train_cache_version = 1
+
+
+def cached_train_gen(cache_dir, **kwargs):
+    """
+    pendulum_train_gen (image mode), saved to cache_dir on the first call and memory mapped
+    on later ones. Note that every run with the same arguments then sees the same data.
+    :return: energy, data, angle
+    """
+    key = dict(kwargs, version=_train_cache_version)
+    key = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, "pendulum_" + key)
+    names = ["k2", "data", "q"]
+    if not os.path.isdir(path):
+        # written to a temporary directory and renamed into place, so parallel runs with the
+        # same arguments never see a partial set or mix arrays from two different draws
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix="pendulum_" + key + ".", dir=cache_dir)
+        try:
+            for name, arr in zip(names, pendulum_train_gen(**kwargs)):
+                np.save(os.path.join(tmp, name + ".npy"), arr)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+                # another run got there first, use its copy
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # copy-on-write maps, so torch.from_numpy gets writable arrays
+    return [np.load(os.path.join(path, name + ".npy"), mmap_mode='c') for name in names]
+
+
 class PendulumNumericalDataset(torch.utils.data.Dataset):
     def __init__(self, size=10240, trajectory_length=100, noise=0.00):
         self.size = size
-        self.k2, self.data = pendulum_train_gen(size, noise=noise, image=False)
+        self.k2, data = pendulum_train_gen(size, traj_samples=trajectory_length, nnoise=noise, image=False)
+        # converted to float32 once instead of per item
+        self.data = torch.from_numpy(data).float()
         self.trajectory_length = trajectory_length
 
     def __getitem__(self, idx):
-        i = random.randint(0, self.trajectory_length - 1)
-        j = random.randint(0, self.trajectory_length - 1)
-        if torch.cuda.is_available():
-            return [
-                torch.cuda.FloatTensor(self.data[idx][i]),
-                torch.cuda.FloatTensor(self.data[idx][j]),
-                self.k2[idx]
-            ]  # [first_view, second_view, energy]
+        if isinstance(idx, (tuple, list)):
+            idx, i, j = idx  # from TrajectoryPairSampler
         else:
-            return [
-                torch.FloatTensor(self.data[idx][i]),
-                torch.FloatTensor(self.data[idx][j]),
-                self.k2[idx]
-            ]
+            i = random.randint(0, self.trajectory_length - 1)
+            j = random.randint(0, self.trajectory_length - 1)
+        return [
+            self.data[idx, i],
+            self.data[idx, j],
+            self.k2[idx]
+        ]  # [first_view, second_view, energy]
 
     def __len__(self):
         return self.size
@@ -373,51 +553,160 @@ class PendulumNumericalDataset(torch.utils.data.Dataset):
 class PendulumImageDataset(torch.utils.data.Dataset):
     def __init__(self, size=5120, trajectory_length=20, nnoise=0.00, gnoise=0.00,
                     img_size=32, diff_time=0.5, gaps=-1, crop=1.0, crop_c=[.75,.5],
-                    t_window=[-1,-1], t_range=-1, mink=0, maxk=1, full_out=False):
-        self.k2, self.data, self.q = pendulum_train_gen(size, nnoise=nnoise, gnoise=gnoise, traj_samples=trajectory_length,
-                                                img_size=img_size, diff_time=diff_time, gaps=gaps, crop=crop, crop_c=crop_c,
-                                                t_window=t_window, t_range=t_range, mink=mink, maxk=maxk)
+                    t_window=[-1,-1], t_range=-1, mink=0, maxk=1, full_out=False, cache_dir=None):
+        gen_args = dict(data_size=size, nnoise=nnoise, gnoise=gnoise, traj_samples=trajectory_length,
+                        img_size=img_size, diff_time=diff_time, gaps=gaps, crop=crop, crop_c=crop_c,
+                        t_window=t_window, t_range=t_range, mink=mink, maxk=maxk)
+        if cache_dir is None:
+            self.k2, self.data, self.q = pendulum_train_gen(**gen_args)
+        else:
+            self.k2, self.data, self.q = cached_train_gen(cache_dir, **gen_args)
         self.trajectory_length = trajectory_length
         self.full = full_out
         self.size = size
 
     def __getitem__(self, idx):
+        # views stay on the cpu; the loops move whole (pinned) batches to the gpu
         if not self.full:
-            i = random.randint(0, self.trajectory_length - 1)
-            j = random.randint(0, self.trajectory_length - 1)
-            if torch.cuda.is_available():
-                return [
-                    torch.cuda.FloatTensor(self.data[idx][i]),
-                    torch.cuda.FloatTensor(self.data[idx][j]),
-                    self.k2[idx][:2],
-                    self.q[idx][i],
-                    self.q[idx][j]
-                ]  # [first_view, second_view, energy]
+            if isinstance(idx, (tuple, list)):
+                idx, i, j = idx  # from TrajectoryPairSampler
             else:
-                return [
-                    torch.FloatTensor(self.data[idx][i]),
-                    torch.FloatTensor(self.data[idx][j]),
-                    self.k2[idx][:2],
-                    self.q[idx][i],
-                    self.q[idx][j]
-                ]
+                i = random.randint(0, self.trajectory_length - 1)
+                j = random.randint(0, self.trajectory_length - 1)
+            return [
+                torch.from_numpy(self.data[idx][i]),
+                torch.from_numpy(self.data[idx][j]),
+                self.k2[idx][:2],
+                self.q[idx][i],
+                self.q[idx][j]
+            ]  # [first_view, second_view, energy]
         else:
-            if torch.cuda.is_available():
-                return [
-                    torch.cuda.FloatTensor(self.data[idx]),
-                    self.k2[idx],
-                    self.q[idx]
-                ]  # [first_view, second_view, energy]
-            else:
-                return [
-                    torch.FloatTensor(self.data[idx]),
-                    self.k2[idx],
-                    self.q[idx]
-                ]
+            return [
+                torch.from_numpy(self.data[idx]).float(),
+                self.k2[idx],
+                self.q[idx]
+            ]
 
     def __len__(self):
         return self.size
 
+class TrajectoryPairSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler yielding (pendulum, first sample, second sample) index triples.
+    Pendulums are shuffled every epoch and the sample pairs for the whole epoch are
+    drawn at once, instead of two random.randint calls per __getitem__.
+    """
+
+    def __init__(self, size, trajectory_length, batch_size, drop_last=True):
+        self.size = size
+        self.trajectory_length = trajectory_length
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        order = torch.randperm(self.size)
+        samples = torch.randint(0, self.trajectory_length, (self.size, 2))
+        triples = torch.cat((order[:, None], samples), dim=1).tolist()
+        for it in range(len(self)):
+            yield triples[it * self.batch_size:(it + 1) * self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.size // self.batch_size
+        return (self.size + self.batch_size - 1) // self.batch_size
+
+class DataPrefetcher(object):
+    """
+    Iterates over a DataLoader, copying the next batch to the gpu on a side stream
+    while the current one is trained on. Without cuda, batches are passed through.
+    :param channels_last: also convert image batches to channels_last on the side stream
+    """
+
+    def __init__(self, loader, channels_last=False):
+        self.loader = iter(loader)
+        self.channels_last = channels_last
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.preload()
+
+    def preload(self):
+        try:
+            self.batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+
+        if self.stream is None:
+            self.batch = [self.prepare(x) for x in self.batch]
+        else:
+            with torch.cuda.stream(self.stream):
+                self.batch = [self.prepare(x.cuda(non_blocking=True)) for x in self.batch]
+
+    def prepare(self, x):
+        # image batches are copied as uint8 and only converted to float on the device
+        if x.dim() == 4:
+            if self.channels_last and self.stream is not None:
+                x = x.to(dtype=torch.float32, memory_format=torch.channels_last)
+            else:
+                x = x.float()
+        return x
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+
+        if self.stream is not None:
+            # the copies were allocated on the side stream but are used on this one
+            for x in batch:
+                x.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
+
+class DeviceBatchLoader(object):
+    """
+    Replaces the DataLoader + DataPrefetcher pair when the training set fits in gpu memory.
+    The (uint8) images are copied to the device once, and every batch, including the
+    sample pairs, is drawn and gathered there. Yields the same
+    [first_view, second_view, energy, first_angle, second_angle] batches.
+    :param channels_last: convert image batches to channels_last
+    """
+
+    def __init__(self, dataset, batch_size, channels_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.channels_last = channels_last
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.data = torch.from_numpy(np.ascontiguousarray(dataset.data)).to(self.device)
+        self.k2 = torch.from_numpy(np.ascontiguousarray(dataset.k2[:, :2])).to(self.device)
+        self.q = torch.from_numpy(np.ascontiguousarray(dataset.q)).to(self.device)
+
+    def prepare(self, x):
+        if self.channels_last and self.device == "cuda":
+            return x.to(dtype=torch.float32, memory_format=torch.channels_last)
+        return x.float()
+
+    def __iter__(self):
+        order = torch.randperm(self.dataset.size, device=self.device)
+        samples = torch.randint(0, self.dataset.trajectory_length, (self.dataset.size, 2), device=self.device)
+        for it in range(len(self)):
+            idx = order[it * self.batch_size:(it + 1) * self.batch_size]
+            i, j = samples[it * self.batch_size:(it + 1) * self.batch_size].unbind(1)
+            yield [
+                self.prepare(self.data[idx, i]),
+                self.prepare(self.data[idx, j]),
+                self.k2[idx],
+                self.q[idx, i],
+                self.q[idx, j]
+            ]
+
+    def __len__(self):
+        return self.dataset.size // self.batch_size
+
 # models
 class ProjectionMLP(nn.Module):
     def __init__(self, in_dim, hidden_dim, out_dim, deeper=False, affine=False):
@@ -512,21 +801,31 @@ class Branch(nn.Module):
         else:
             # self.projector = ProjectionMLP(32, 64, 32, affine=affine, deeper=deeper)
             self.projector = ProjectionMLP(repr_dim, proj_hidden, proj_out, affine=affine, deeper=deeper)
+        self.use_projector = proj_out != -1
 
-        self.net = nn.Sequential(
-            self.encoder,
-            self.projector
-        )
+        # older checkpoints also hold the encoder / projector under "net."
+        # (the public hook API is torch >= 2.5, before that only the private one exists)
+        if hasattr(self, "register_load_state_dict_pre_hook"):
+            self.register_load_state_dict_pre_hook(self._drop_net_keys)
+        else:
+            self._register_load_state_dict_pre_hook(self._drop_net_keys, with_module=True)
+
+    @staticmethod
+    def _drop_net_keys(module, state_dict, prefix, *args):
+        for key in [k for k in state_dict if k.startswith(prefix + "net.")]:
+            del state_dict[key]
 
     def forward(self, x):
-        return self.net(x)
+        if self.use_projector:
+            return self.projector(self.encoder(x))
+        return self.encoder(x)
 
 
 # loops
 
 def plotting_loop(args):
     # TODO: can be used to plot the data in 2D.
-    k2, data = pendulum_train_gen(100, noise=0.05)
+    k2, data = pendulum_train_gen(100, nnoise=0.05, image=False)
     for traj in data:
         plt.scatter(traj[:, 0], traj[:, 1], s=5.)
     plt.xlabel(r"angle $\theta$")
@@ -534,15 +833,19 @@ def plotting_loop(args):
     plt.savefig(os.path.join(args.path_dir, 'dataset.png'), dpi=300)
 
 def supervised_loop(args, encoder=None):
-    dataloader_kwargs = dict(drop_last=True, pin_memory=False, num_workers=0)
-    train_loader = torch.utils.data.DataLoader(
-        dataset=PendulumImageDataset(size=args.data_size, trajectory_length=args.traj_len, nnoise=args.nnoise, gnoise=args.gnoise,
+    dataloader_kwargs = dict(pin_memory=True, num_workers=4, persistent_workers=True, prefetch_factor=4)
+    train_dataset = PendulumImageDataset(size=args.data_size, trajectory_length=args.traj_len, nnoise=args.nnoise, gnoise=args.gnoise,
                                         img_size=args.img_size, diff_time=args.diff_time, gaps=args.gaps, crop=args.crop, crop_c = args.crop_c,
-                                        t_window=args.t_window, t_range=args.t_range, mink=args.mink, maxk=args.maxk),
-        shuffle=True,
-        batch_size=args.bsz,
-        **dataloader_kwargs
-    )
+                                        t_window=args.t_window, t_range=args.t_range, mink=args.mink, maxk=args.maxk,
+                                        cache_dir=(args.data_cache if args.data_cache != "" else None))
+    if args.gpu_data:
+        train_loader = DeviceBatchLoader(train_dataset, args.bsz, channels_last=True)
+    else:
+        train_loader = torch.utils.data.DataLoader(
+            dataset=train_dataset,
+            batch_sampler=TrajectoryPairSampler(args.data_size, args.traj_len, args.bsz),
+            **dataloader_kwargs
+        )
     if args.save_training_data:
         np.save(os.path.join(args.path_dir, "training_data.npy"), train_loader.dataset.data)
         np.save(os.path.join(args.path_dir, "training_k2.npy"), train_loader.dataset.k2)
@@ -552,6 +855,7 @@ def supervised_loop(args, encoder=None):
             dataset=PendulumImageDataset(size=512, gaps=args.gaps),
             shuffle=False,
             batch_size=512,
+            drop_last=True,
             **dataloader_kwargs
         )
     if verbose:
@@ -561,13 +865,15 @@ def supervised_loop(args, encoder=None):
     main_branch = Branch(args.repr_dim, deeper=args.deeper, affine=args.affine, encoder=encoder)
     if torch.cuda.is_available():
         main_branch.cuda()
+        main_branch.to(memory_format=torch.channels_last) # lets cudnn use its NHWC conv kernels
 
     # optimization
     optimizer = torch.optim.SGD(
         main_branch.parameters(),
         momentum=0.9,
         lr=args.lr,
-        weight_decay=args.wd
+        weight_decay=args.wd,
+        foreach=True
     )
     lr_scheduler = LRScheduler(
         optimizer=optimizer,
@@ -580,8 +886,11 @@ def supervised_loop(args, encoder=None):
         constant_predictor_lr=True
     )
 
+    use_amp, amp_dtype, scaler = mixed_precision(args.amp)
+
     # macros
     b = main_branch.encoder
+    b_fwd = compile_model(b, args.compile)
 
     if verbose:
         print("[Supervised] Model generation complete, training begins")
@@ -605,18 +914,22 @@ def supervised_loop(args, encoder=None):
         b.train()
 
         # epoch
-        for it, (x1, x2, energy, q1, q2) in enumerate(train_loader):
+        for it, (x1, x2, energy, q1, q2) in enumerate(train_loader if args.gpu_data else DataPrefetcher(train_loader, channels_last=True)):
             # zero grad
-            b.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
 
             # forward pass
-            out = b(x1)
-            out_loss = loss(out, energy.float().cuda()[:, :1, 0])
+            with torch.autocast("cuda", dtype=amp_dtype, enabled=use_amp):
+                out = b_fwd(x1)
+            # the loss is computed in float32 outside of autocast
+            out_loss = loss(out.float(), energy.float()[:, :1, 0])
 
             # optimization step
-            out_loss.backward()
-            torch.nn.utils.clip_grad_norm_(b.parameters(), 3)
-            optimizer.step()
+            scaler.scale(out_loss).backward()
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(b.parameters(), 3, foreach=True)
+            scaler.step(optimizer)
+            scaler.update()
 
             lr_scheduler.step()
 
@@ -625,7 +938,10 @@ def supervised_loop(args, encoder=None):
                 b.eval()
                 val_loss = -1
                 for it, (x1, x2, energy, q1, q2) in enumerate(test_loader):
-                    val_loss = loss(b(x1), energy.float())
+                    if torch.cuda.is_available():
+                        x1 = x1.cuda(non_blocking=True)
+                        energy = energy.cuda(non_blocking=True)
+                    val_loss = loss(b(x1.float()), energy.float())
                     break
                 line_to_print = f'epoch: {e} | loss: {out_loss.item()} | val loss: {val_loss.item()} | time_elapsed: {time.time() - start:.3f}'
             else:
@@ -652,20 +968,25 @@ def supervised_loop(args, encoder=None):
 
 def training_loop(args, encoder=None):
     # dataset
-    dataloader_kwargs = dict(drop_last=True, pin_memory=False, num_workers=0)
-    train_loader = torch.utils.data.DataLoader(
-        dataset=PendulumImageDataset(size=args.data_size, trajectory_length=args.traj_len, nnoise=args.nnoise, gnoise=args.gnoise,
+    dataloader_kwargs = dict(pin_memory=True, num_workers=4, persistent_workers=True, prefetch_factor=4)
+    train_dataset = PendulumImageDataset(size=args.data_size, trajectory_length=args.traj_len, nnoise=args.nnoise, gnoise=args.gnoise,
                                         img_size=args.img_size, diff_time=args.diff_time, gaps=args.gaps, crop=args.crop, crop_c = args.crop_c,
-                                        t_window=args.t_window, t_range=args.t_range, mink=args.mink, maxk=args.maxk),
-        shuffle=True,
-        batch_size=args.bsz,
-        **dataloader_kwargs
-    )
+                                        t_window=args.t_window, t_range=args.t_range, mink=args.mink, maxk=args.maxk,
+                                        cache_dir=(args.data_cache if args.data_cache != "" else None))
+    if args.gpu_data:
+        train_loader = DeviceBatchLoader(train_dataset, args.bsz, channels_last=True)
+    else:
+        train_loader = torch.utils.data.DataLoader(
+            dataset=train_dataset,
+            batch_sampler=TrajectoryPairSampler(args.data_size, args.traj_len, args.bsz),
+            **dataloader_kwargs
+        )
     if args.validation:
         test_loader = torch.utils.data.DataLoader(
             dataset=PendulumImageDataset(size=512, gaps=args.gaps),
             shuffle=False,
             batch_size=512,
+            drop_last=True,
             **dataloader_kwargs
         )
     if verbose:
@@ -675,6 +996,7 @@ def training_loop(args, encoder=None):
     main_branch = Branch(args.repr_dim, deeper=args.deeper, affine=args.affine, encoder=encoder)
     if torch.cuda.is_available():
         main_branch.cuda()
+        main_branch.to(memory_format=torch.channels_last) # lets cudnn use its NHWC conv kernels
 
     if args.method == "simsiam":
         h = PredictionMLP(args.repr_dim, args.dim_pred, args.repr_dim)
@@ -686,7 +1008,8 @@ def training_loop(args, encoder=None):
         main_branch.parameters(),
         momentum=0.9,
         lr=args.lr,
-        weight_decay=args.wd
+        weight_decay=args.wd,
+        foreach=True
     ) # extremely sensitive to learning rate
     lr_scheduler = LRScheduler(
         optimizer=optimizer,
@@ -703,25 +1026,29 @@ def training_loop(args, encoder=None):
             h.parameters(),
             momentum=0.9,
             lr=args.pred_lr,
-            weight_decay=args.wd
+            weight_decay=args.wd,
+            foreach=True
         )
 
+    use_amp, amp_dtype, scaler = mixed_precision(args.amp)
+
     # macros
-    b = main_branch.encoder
-    proj = main_branch.projector
+    branch_fwd = compile_model(main_branch, args.compile)
+    if args.method == "simsiam":
+        h_fwd = compile_model(h, args.compile)
 
     # helpers
     def get_z(x):
-        return proj(b(x))
+        return branch_fwd(x)
 
     def apply_loss(z1, z2, distance):
         #if args.loss == 'square':
         #    loss = (z1 - z2).pow(2).sum()
         if args.method == 'infonce':
-            loss = 0.5 * info_nce(z1, z2, temperature=args.temp, distance=distance) + 0.5 * info_nce(z2, z1, temperature=args.temp, distance=distance)
+            loss = info_nce(z1, z2, temperature=args.temp, distance=distance, symmetric=True)
         elif args.method == 'simsiam':
-            p1 = h(z1)
-            p2 = h(z2)
+            p1 = h_fwd(z1)
+            p2 = h_fwd(z2)
             loss = simsiam_loss(p1, z2, distance=distance) / 2 + simsiam_loss(p2, z1, distance=distance) / 2
         return loss
 
@@ -748,52 +1075,63 @@ def training_loop(args, encoder=None):
 
         # epoch
         losses = []
-        zmin = torch.tensor(10000)
-        zmax = torch.tensor(-10000)
-        for it, (x1, x2, energy, q1, q2) in enumerate(train_loader):
+        zmin = torch.tensor(10000.)
+        zmax = torch.tensor(-10000.)
+        for it, (x1, x2, energy, q1, q2) in enumerate(train_loader if args.gpu_data else DataPrefetcher(train_loader, channels_last=True)):
             # zero grad
-            main_branch.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             if args.method == "simsiam":
-                h.zero_grad()
+                pred_optimizer.zero_grad(set_to_none=True)
 
             # forward pass
-            z1 = get_z(x1)
-            z2 = get_z(x2)
-
-            zmin = torch.min(torch.min(z1, zmin))
-            zmax = torch.max(torch.max(z1, zmax))
-            zmin = torch.min(torch.min(z2, zmin))
-            zmax = torch.max(torch.max(z2, zmax))
+            with torch.autocast("cuda", dtype=amp_dtype, enabled=use_amp):
+                z1 = get_z(x1)
+                z2 = get_z(x2)
+
+            # normalization, logits and softmax are sensitive to rounding, so the
+            # loss (and the small simsiam predictor) run in float32 outside of autocast
+            z1 = z1.float()
+            z2 = z2.float()
             if args.cosine:
                 loss = apply_loss(z1, z2, distance="cosine")
             else:
                 loss = apply_loss(z1, z2, distance="euclidean")
-            losses.append(loss.item())
+
+            # stats stay on the device (no sync) until they are printed
+            with torch.no_grad():
+                zmin = torch.minimum(zmin, torch.min(z1.min(), z2.min()))
+                zmax = torch.maximum(zmax, torch.max(z1.max(), z2.max()))
+            losses.append(loss.detach())
 
             # optimization step
-            loss.backward()
+            scaler.scale(loss).backward()
             if args.clip != -1:
-                torch.nn.utils.clip_grad_norm_(main_branch.parameters(), args.clip)
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(main_branch.parameters(), args.clip, foreach=True)
                 if args.method == "simsiam":
-                    torch.nn.utils.clip_grad_norm_(h.parameters(), args.clip * 2)
-            optimizer.step()
+                    scaler.unscale_(pred_optimizer)
+                    torch.nn.utils.clip_grad_norm_(h.parameters(), args.clip * 2, foreach=True)
+            scaler.step(optimizer)
             lr_scheduler.step()
             if args.method == "simsiam":
-                pred_optimizer.step()
+                scaler.step(pred_optimizer)
+            scaler.update()
 
         if e % args.progress_every == 0 or e % args.save_every == 0:
             if args.validation:
                 main_branch.eval()
                 val_loss = -1
                 for it, (x1, x2, energy, q1, q2) in enumerate(test_loader):
-                    val_loss = loss(get_z(x1), get_z(x2)).item()
+                    if torch.cuda.is_available():
+                        x1 = x1.cuda(non_blocking=True)
+                        x2 = x2.cuda(non_blocking=True)
+                    val_loss = loss(get_z(x1.float()), get_z(x2.float())).item()
                     break
                 line_to_print = f'epoch: {e} | loss: {loss.item()} | val loss: {val_loss.item()} | time_elapsed: {time.time() - start:.3f}'
             else:
-                losses = torch.tensor(losses)
-                losses = torch.std(losses)
+                losses = torch.std(torch.stack(losses).float())
                 zrange = zmax - zmin
-                line_to_print = f'epoch: {e} | loss: {loss.item()} | std: {losses.item()} | range: {zrange} | time_elapsed: {time.time() - start:.3f}'
+                line_to_print = f'epoch: {e} | loss: {loss.item()} | std: {losses.item()} | range: {zrange.item()} | time_elapsed: {time.time() - start:.3f}'
 
             print(line_to_print)
 
@@ -850,6 +1188,7 @@ def testing_loop(args, encoder=None):
 
         if torch.cuda.is_available():
             branch.cuda()
+            branch.to(memory_format=torch.channels_last)
 
         branch.eval()
         b.append(branch.encoder)
@@ -879,16 +1218,21 @@ def testing_loop(args, encoder=None):
 
     coded = np.zeros((len(b), args.data_size, args.traj_len, data_args["repr_dim"]))
 
-    if torch.cuda.is_available():
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    with torch.no_grad():
         for i in range(len(b)):
             if verbose:
                 print("[testing] testing " + load_files[i])
+            # outputs stay on the device, one transfer per model
+            out = torch.empty((args.data_size, args.traj_len, data_args["repr_dim"]), device=device)
             for j in range(0, args.data_size):
-                coded[i, j, :, :] = b[i](torch.FloatTensor(test_data[j, :, :, :, :]).cuda()).cpu().detach().numpy()
-    else:
-        for i in range(len(b)):
-            for j in range(0, args.data_size):
-                coded[i, j, :, :] = b[i](torch.FloatTensor(test_data[j, :, :, :, :])).detach().numpy()
+                x = torch.from_numpy(test_data[j]).to(device, non_blocking=True)
+                if device == "cuda":
+                    x = x.to(dtype=torch.float32, memory_format=torch.channels_last)
+                else:
+                    x = x.float()
+                out[j] = b[i](x)
+            coded[i] = out.cpu().numpy()
     energies = test_k2[:, 0]
     qs = test_q
 
@@ -939,6 +1283,7 @@ def analysis_loop(args, encoder=None):
 
         if torch.cuda.is_available():
             branch.cuda()
+            branch.to(memory_format=torch.channels_last)
 
         branch.eval()
         b.append(branch.encoder)
@@ -979,6 +1324,8 @@ def analysis_loop(args, encoder=None):
         data = torch.FloatTensor(data)
         if torch.cuda.is_available():
             data = data.cuda()
+            if not args.use_training_data:
+                data = data.contiguous(memory_format=torch.channels_last)
 
         lens = [borders[0]] + list(np.array(borders[1:]) - np.array(borders[:-1])) + list(1 - np.array([borders[-1]]))
         lens = np.array(lens)
@@ -989,7 +1336,7 @@ def analysis_loop(args, encoder=None):
             b[i].eval()
             with torch.no_grad():
                 if args.use_training_data:
-                    out = torch.zeros((data.shape[0], data_args["repr_dim"]))
+                    out = torch.zeros((data.shape[0], data_args["repr_dim"]), device=data.device)
                     shp = list(data.shape)
                     shp.insert(0, shp[0] // 16)
                     shp[1] = 16
@@ -998,7 +1345,7 @@ def analysis_loop(args, encoder=None):
                         out[16 * j:16 * (j + 1)] = b[i](data[j])
                 else:
                     out = b[i](data)
-                out = out.cpu().detach().numpy()
+                out = out.cpu().numpy()
 
                 if np.size(out, axis=1) > 1:
                     spectral = SpectralEmbedding(n_components=1)
@@ -1298,7 +1645,8 @@ def main(args):
         raise UserWarning("please do not pass empty experiment names")
     args.path_dir = '../output/pendulum/' + args.path_dir
 
-    set_deterministic(42)
+    # autotuned kernels under --compile
+    set_deterministic(42, cudnn_benchmark=args.compile)
     if args.mode == 'training':
         training_loop(args)
     elif args.mode == 'testing':
@@ -1335,6 +1683,8 @@ if __name__ == '__main__':
     parser.add_argument('--diff_time', default=0.5, type=float)
 
     parser.add_argument('--save_training_data', default=False, action='store_true')
+    parser.add_argument('--data_cache', default='', type=str)
+    parser.add_argument('--gpu_data', default=False, action='store_true')
     parser.add_argument('--use_training_data', default=False, action='store_true')
 
     parser.add_argument('--gaps', default="-1,-1", type=str)
@@ -1376,6 +1726,8 @@ if __name__ == '__main__':
 
     parser.add_argument('--temp', default=0.1, type=float)
     parser.add_argument('--clip', default=3.0, type=float)
+    parser.add_argument('--amp', default=False, action='store_true')
+    parser.add_argument('--compile', default=False, action='store_true')
 
     # NN size options
     parser.add_argument('--dim_pred', default=1, type=int)
@@ -1,70 +1,121 @@
+import os
+import sys
 import json
 import numpy as np
 
-try:
-    import matplotlib
-    matplotlib.use('TkAgg')
-except Exception:
-    import matplotlib
-    matplotlib.use('ps')
-    pass
+# interactive window only on a terminal with a display, otherwise render with Agg to a file
+import matplotlib
+interactive = sys.stdout.isatty() and bool(os.environ.get("DISPLAY"))
+if interactive:
+    try:
+        matplotlib.use('TkAgg')
+    except Exception:
+        interactive = False
+if not interactive:
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 expname = "dataset"
 
-with open("../data/master_experiments.json", "r") as f:
-    data = json.load(f)
-
-keys = list(data.keys())
-for key in keys:
-    if expname not in data[key]["experiment_name"] or int(data[key]["experiment_name"][0]) > 4:
-        data.pop(key)
-
-crop = [640,960,1280,1920,2560,5120]
-orig_crop = crop
-for i in range(0, len(crop)):
-    crop[i] = str(crop[i])
-
-res = np.zeros((len(crop),5))
-resp = np.zeros((len(crop),5,7))
-sres= np.zeros((len(crop),5))
-sresp = np.zeros((len(crop),5,7))
-
-for key in data.keys():
-    exp = data[key]["experiment_name"]
-    print(exp)
-    trial = int(exp[0])
-    sup = False
-    if exp.endswith("_sup"):
-        sup = True
-        exp = exp[:-4]
-    num = exp[exp.rfind("_") + 1:]
-
-    if sup:
-        sres[crop.index(num), trial] = data[key]["full_spearman"]
-        sresp[crop.index(num), trial] = np.array(data[key]["k_spearman"])[1:-1]
-    else:
-        res[crop.index(num), trial] = data[key]["full_spearman"]
-        resp[crop.index(num), trial] = np.array(data[key]["k_spearman"])[1:-1]
+def load_experiments(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+orig_crop = [640,960,1280,1920,2560,5120]
+crop = [str(c) for c in orig_crop]
+crop_idx = {c: i for i, c in enumerate(crop)}
+
+max_trial = 4
+
+json_path = "../data/master_experiments.json"
+# the reduced results, reused while the experiment file and the reduction are unchanged
+# (untracked, see .gitignore). bump cache_version whenever spearman_results changes
+cache_path = "../data/dataset_plot_cache.npz"
+cache_version = 1
+
+def spearman_results():
+    """
+    Global and local spearman per noise level (averaged over trials), for plain and supervised runs.
+    :return: res, resp, sres, sresp
+    """
+    data = load_experiments(json_path)
+
+    # names start with the trial digit; anything else is not one of these runs
+    data = {key: entry for key, entry in data.items()
+            if expname in entry["experiment_name"] and entry["experiment_name"][:1].isdigit()
+            and int(entry["experiment_name"][0]) <= max_trial}
+
+    res = np.zeros((len(crop),5), dtype=np.float32)
+    resp = np.zeros((len(crop),5,7), dtype=np.float32)
+    sres= np.zeros((len(crop),5), dtype=np.float32)
+    sresp = np.zeros((len(crop),5,7), dtype=np.float32)
+
+    # collect (crop, trial) positions and values, then write them all at once
+    idxs, trials, sups, fulls, kspears = [], [], [], [], []
+    for entry in data.values():
+        exp = entry["experiment_name"]
+        print(exp)
+        trial = int(exp[0])
+        # <trial>..._<noise>[_sup]
+        head, _, num = exp.rpartition("_")
+        sup = num == "sup"
+        if sup:
+            num = head.rpartition("_")[2]
+
+        idxs.append(crop_idx[num])
+        trials.append(trial)
+        sups.append(sup)
+        fulls.append(entry["full_spearman"])
+        kspears.append(entry["k_spearman"][1:-1])
+
+    idxs = np.asarray(idxs, dtype=int)
+    trials = np.asarray(trials, dtype=int)
+    sups = np.asarray(sups, dtype=bool)
+    fulls = np.asarray(fulls, dtype=np.float32)
+    kspears = np.asarray(kspears, dtype=np.float32).reshape((-1, 7))
+
+    sres[idxs[sups], trials[sups]] = fulls[sups]
+    sresp[idxs[sups], trials[sups]] = kspears[sups]
+    res[idxs[~sups], trials[~sups]] = fulls[~sups]
+    resp[idxs[~sups], trials[~sups]] = kspears[~sups]
+
+    np.abs(res, out=res)
+    np.abs(resp, out=resp)
+    np.abs(sres, out=sres)
+    np.abs(sresp, out=sresp)
+
+    #res = np.log(1 - res)
+    #resp = np.log(1 - resp)
+    #sres = np.log(1 - sres)
+    #sresp = np.log(1 - sresp)
+
+    res = np.mean(res, axis=1)
+    resp = np.mean(resp, axis=1)
+    sres = np.mean(sres, axis=1)
+    sresp = np.mean(sresp, axis=1)
+    return res, resp, sres, sresp
+
+cache_key = json.dumps(dict(version=cache_version, mtime=os.path.getmtime(json_path), expname=expname,
+                            crop=orig_crop, max_trial=max_trial, dtype="float32"))
+cached = None
+if os.path.exists(cache_path):
+    cached = np.load(cache_path)
+    if "key" not in cached.files or str(cached["key"]) != cache_key:
+        cached = None
+if cached is not None:
+    res, resp, sres, sresp = (cached[k] for k in ("res", "resp", "sres", "sresp"))
+else:
+    res, resp, sres, sresp = spearman_results()
+    np.savez(cache_path, res=res, resp=resp, sres=sres, sresp=sresp, key=cache_key)
 
 w = plt.get_cmap('plasma')
-res = np.abs(res)
-resp = np.abs(resp)
-sres = np.abs(sres)
-sresp = np.abs(sresp)
-
-#res = np.log(1 - res)
-#resp = np.log(1 - resp)
-#sres = np.log(1 - sres)
-#sresp = np.log(1 - sresp)
-
-res = np.mean(res, axis=1)
-resp = np.mean(resp, axis=1)
-sres = np.mean(sres, axis=1)
-sresp = np.mean(sresp, axis=1)
 print(res)
 print(sres)
 
+# local spearman averaged over the segments, one value per noise level
+resp_line = np.mean(resp, axis=1)
+sresp_line = np.mean(sresp, axis=1)
+
 def OneMinusLog(arr):
     return -1 * (np.log(1 - arr))
 
@@ -72,7 +123,7 @@ def OneMinusLogInv(arr):
     return 1 - np.exp(-1 * arr)
 
 
-fig, ax1 = plt.subplots()
+fig, ax1 = plt.subplots(constrained_layout=True)
 
 ax1.set_xscale('log')
 #ax1.set_yscale('function', functions=(OneMinusLog, OneMinusLogInv))
@@ -80,8 +131,8 @@ ax1.set_xlabel("Noise")
 ax1.set_ylabel("Global Spearman", color=[1,0,0])
 ax1.tick_params(axis='y', labelcolor=[1,0,0])
 
-ax1.plot(orig_crop, res, lw=0.75, color=[1,0,0])
-ax1.plot(orig_crop, sres, lw=0.75, color=[1,0,0], linestyle="--")
+ax1.plot(orig_crop, res, lw=0.75, color=[1,0,0], rasterized=True)
+ax1.plot(orig_crop, sres, lw=0.75, color=[1,0,0], linestyle="--", rasterized=True)
 
 ax2=ax1.twinx()
 
@@ -89,11 +140,13 @@ ax2=ax1.twinx()
 ax2.set_ylabel("Local Spearman", color=[0,1,0])
 ax2.tick_params(axis='y', labelcolor=[0,1,0])
 
-ax2.plot(orig_crop, np.mean(resp,axis=1), lw=0.75, color=[0,1,0])
-ax2.plot(orig_crop, np.mean(sresp,axis=1), lw=0.75, color=[0,1,0], linestyle="--")
+ax2.plot(orig_crop, resp_line, lw=0.75, color=[0,1,0], rasterized=True)
+ax2.plot(orig_crop, sresp_line, lw=0.75, color=[0,1,0], linestyle="--", rasterized=True)
 
-fig.tight_layout()
-plt.show()
+if interactive:
+    plt.show()
+else:
+    fig.savefig("../data/dataset_spearman.png", dpi=200)
 
 plt.clf()
 
@@ -102,23 +155,24 @@ plt.yscale('linear')
 
 x=[1,2,3,4,5,6,7]
 
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+
 subrange = [1,4,7]
-colors = {}
-for it, i in enumerate(subrange):
-    colors[i] = np.array(w((it)/(len(subrange) - 1)))
-for it, i in enumerate(subrange):
-    plt.plot(x, resp[i], lw=0.75, linestyle="-", c=colors[i], label=orig_crop[i])
-    plt.plot(x, sresp[i], lw=0.5, linestyle="--", c=colors[i])
+colors = w(np.linspace(0, 1, len(subrange)))
+# one collection per line style instead of one Line2D per curve
+ax = plt.gca()
+ax.add_collection(LineCollection([np.column_stack((x, resp[i])) for i in subrange], colors=colors, linewidths=0.75, linestyles="-"))
+ax.add_collection(LineCollection([np.column_stack((x, sresp[i])) for i in subrange], colors=colors, linewidths=0.5, linestyles="--"))
+ax.autoscale_view()
 plt.plot(x, resp[0], lw=1, linestyle="-", c="k")
 plt.plot(x, sresp[0], lw=1, linestyle="--", c="k")
-plt.legend()
+plt.legend(handles=[Line2D([], [], lw=0.75, c=colors[it], label=orig_crop[i]) for it, i in enumerate(subrange)])
 plt.xlabel("Segment")
 plt.ylabel("Local Spearman")
 plt.show()"""
 """
-fig, axs=plt.subplots()
-axs.set_visible(False)
-ax1  = fig.add_axes([0.10,0.10,0.70,0.85])
+fig, (ax1, ax2) = plt.subplots(1, 2, gridspec_kw={"width_ratios": [14, 1]}, constrained_layout=True)
 
 ax1.set_yscale("log")
 ax1.set_xscale("linear")
@@ -126,6 +180,7 @@ ax1.set_xscale("linear")
 ax1.set_ylabel("Noise")
 ax1.set_xlabel("Encoding")
 
+data = load_experiments(json_path)
 seen_exps = []
 ax1.axvline(x=0, lw=1, linestyle="--", c="k")
 for key in data.keys():
@@ -142,20 +197,26 @@ for key in data.keys():
     else:
         seen_exps.append(exp)
     
-    coded = np.load("../../output/pendulum/" + exp + "/testing/coded-100.npy")
-    energies = np.load("../../output/pendulum/" + exp + "/testing/energies.npy")
+    dsize = 102400
+    # memory mapped: the median reads it once, then only the subsample is copied out
+    coded = np.load("../../output/pendulum/" + exp + "/testing/coded-100.npy", mmap_mode="r").reshape(dsize)
+    energies = np.load("../../output/pendulum/" + exp + "/testing/energies.npy").astype(np.float32, copy=False)
 
-    noise = exp[exp.rfind("_") + 1:]
+    noise = exp.rpartition("_")[2]
     noise = float(1 / int(noise))
 
     ax1.axhline(y=noise, lw=0.35, linestyle="-", c="k")
 
-    dsize = 102400
-    coded = np.reshape(coded, (dsize))
-    energies = np.tile(energies, (1, 10))
-    energies = np.reshape(energies, (dsize))
-    idx = np.random.permutation(dsize)
-    coded = coded[idx]
+    # one energy per pendulum (testing saves k2 for both frames, (N, 2)), repeated
+    # over its 10 samples to line up with coded
+    energies = np.repeat(energies.reshape(len(energies), -1)[:, 0], 10)
+
+    center = np.median(coded)
+    # a random subsample of dsize // 1600 points, drawn without permuting everything
+    idx = np.random.default_rng().choice(dsize, size=dsize // 1600, replace=False)
+    coded = (coded[idx] - center).astype(np.float32)
+    energies = energies[idx]
+    # flipping after centering is the same as centering the flipped encoding
     if expname == "nnoise":
         if orig_crop.index(noise) in [4, 5, 6, 9, 10]:
             coded = -1 * coded
@@ -163,18 +224,10 @@ for key in data.keys():
         if orig_crop.index(noise) in [1,2,4,5, 10]:
             coded = -1 * coded
 
-    coded = coded - np.quantile(coded, 0.5)
-    energies = energies[idx]
-    coded = coded[::1600]
-    energies = energies[::1600]
-
-    cols = []
-    for i in range(0,np.size(energies)):
-        cols.append(w(energies[i]))
+    cols = w(energies)
 
-    ax1.scatter(coded, np.repeat(noise, np.size(coded)), s=1.5, c=cols)
+    ax1.scatter(coded, np.repeat(noise, np.size(coded)), s=1.5, c=cols, rasterized=True)
 norm = matplotlib.colors.Normalize(vmin=0,vmax=1)
-ax2  = fig.add_axes([0.85,0.10,0.05,0.85])
 cb1  = matplotlib.colorbar.ColorbarBase(ax2,cmap=plt.get_cmap("plasma"),norm=norm,orientation='vertical')
 plt.show()"""
     